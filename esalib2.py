@@ -15,18 +15,54 @@
 import argparse
 import bz2
 import datetime
+import functools
+import json
 import math
+import multiprocessing
+import numpy as np
 import os
 import re
 import pickle
 import porter
+import shutil
 import sqlite3
-import struct
+import subprocess
+import sys
 import time
 import wiki_extractor
-import xml.etree.cElementTree as ET
+import xml.etree.ElementTree as ET
 
-from collections import Counter
+from collections import Counter, OrderedDict
+
+try:
+    import zstandard as zstd
+except ImportError:  # term vectors are then stored uncompressed
+    zstd = None
+
+try:
+    import orjson
+except ImportError:  # labels are then serialized with the json module
+    orjson = None
+
+try:
+    import re2  # DFA-based matching, without backtracking
+except ImportError:
+    re2 = None
+
+try:
+    import xxhash
+except ImportError:  # documents are then hashed with the builtin hash
+    xxhash = None
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # the dump is then parsed with xml.etree
+    lxml_etree = None
+
+try:
+    import indexed_bzip2 as ibz2
+except ImportError:  # the dump is then decompressed by lbzip2/pbzip2 or bz2
+    ibz2 = None
 
 # run pdb when error occurs
 import pdberr
@@ -44,49 +80,129 @@ def to_pickle(data, path):
         pickle.dump(data, wrt)
 
 
+def from_jsonl(path):
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(path, 'rb') as rd:
+        for line in rd:
+            yield loads(line)
+
+
+def to_jsonl_line(record):
+    if orjson is not None:
+        return orjson.dumps(record) + b'\n'
+    return json.dumps(record).encode('utf-8') + b'\n'
+
+
+def text_digest(text):
+    """64-bit digest of a text, used to spot documents seen before."""
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(text)
+    return hash(text)
+
+
+def labels_path(labels_file):
+    """Path of the JSON lines file holding the (doc_id, title) labels."""
+    return labels_file + '.jsonl'
+
+
+# on-disk layout of a term vector: (doc_id int32, value float32) records
+TERM_VECTOR_DTYPE = np.dtype([('id', '<i4'), ('v', '<f4')])
+
+
 def binarize(lst):
     """Convert a list of (int, float) tuples into a binary string."""
-    res = []
-    for item in lst:
-        res.append(struct.pack('if', *item))
-    return b"".join(res)
+    arr = np.empty(len(lst), dtype=TERM_VECTOR_DTYPE)
+    arr['id'] = [item[0] for item in lst]
+    arr['v'] = [item[1] for item in lst]
+    return arr.tobytes()
+
+
+# every zstd frame starts with these bytes; a raw vector never does, as it
+# would have to begin with a negative doc_id
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+if zstd is not None:
+    _cctx = zstd.ZstdCompressor(level=3)
+    _dctx = zstd.ZstdDecompressor()
+
+
+def compress(data):
+    """Compress a binarized term vector, if zstandard is available."""
+    if zstd is None:
+        return data
+    return _cctx.compress(data)
+
+
+def decompress(data):
+    """Inverse of `compress`; uncompressed vectors are returned as they are."""
+    if data[:4] != ZSTD_MAGIC:
+        return data
+    if zstd is None:
+        raise RuntimeError("The background contains zstd-compressed term vectors; install zstandard to read it.")
+    return _dctx.decompress(data)
+
+
+def debinarize(tv_str):
+    """Convert a binary string produced by `binarize` back into a record array."""
+    return np.frombuffer(tv_str, dtype=TERM_VECTOR_DTYPE)
 
 
 def sliding_window_filter(doc_list, window_size=100, window_thresh=0.05):
     """Given a list of documents and their scores, build a list that does not
     contain in the tail values that have changed less during last @window_size
     items, than @window_thresh percent of the maximal value."""
-    res = []
-    max_score = None
-    for i, (doc_id, doc_val, ) in enumerate(doc_list):
-        if max_score is None:
-            max_score = doc_val
-
-        if len(res) >= window_size:
-            window_change = doc_list[max(0, i - window_size)][1] - doc_list[max(0, i - 1)][1]
-            if max_score * window_thresh > window_change:
-                break
+    if len(doc_list) <= window_size:
+        return list(doc_list)
 
-        res.append((doc_id, doc_val, ))
-
-    return res
+    vals = np.fromiter((doc_val for _, doc_val in doc_list), dtype=np.float64, count=len(doc_list))
+    # window_change[k] is the change over the window closing before item k + window_size
+    window_change = vals[:-window_size] - vals[window_size - 1:-1]
+    stalled = vals[0] * window_thresh > window_change
+    if not stalled.any():
+        return list(doc_list)
+    return doc_list[:window_size + int(np.argmax(stalled))]
 
 
 def normalize_vector(vector, vector_sq_sum=None):
+    """Scale the (doc_id, value) pairs of the vector in place to unit L2 norm;
+    @vector_sq_sum is the sum of the squared values, if already known."""
+    vals = np.fromiter((val for _, val in vector), dtype=np.float64, count=len(vector))
+    if vector_sq_sum is None:
+        vector_sq_sum = float(vals @ vals)
     if not vector_sq_sum:
-        vector_sq_sum = sum(i**2 for i in vector)
+        return
+
+    vals /= math.sqrt(vector_sq_sum)
+    doc_ids = [doc_id for doc_id, _ in vector]
+    vector[:] = zip(doc_ids, vals.tolist())
+
+
+class LRUCache(object):
+    """functools.lru_cache around a function that can be pickled, e.g. to be
+    sent to worker processes; the cache itself is not, and starts out empty
+    on the other side. Hot loops call `cached` directly."""
+    def __init__(self, func, maxsize):
+        self.func = func
+        self.maxsize = maxsize
+        self.cached = functools.lru_cache(maxsize=maxsize)(func)
+
+    def __getstate__(self):
+        return {'func': self.func, 'maxsize': self.maxsize}
 
-    for i, (doc_id, val) in enumerate(vector):
-        vector[i] = (doc_id, val / vector_sq_sum)
+    def __setstate__(self, state):
+        self.__init__(**state)
 
 
 class FilterStem:
-    def __init__(self):
+    def __init__(self, cache_size=200000):
         self.stemmer = porter.PorterStemmer()
+        # tokens are Zipf-distributed, so a bounded cache absorbs most calls
+        self._stem = LRUCache(self.stemmer.stem, cache_size)
 
     def __call__(self, tokens):
+        stem = self._stem.cached
         for token in tokens:
-            yield self.stemmer.stem(token)
+            yield stem(token)
 
 
 class FilterStopwords:
@@ -111,12 +227,77 @@ def filter_gibberish(tokens):
         yield token
 
 
+class FilterLowerStemStopwords:
+    """Lowercasing, stemming and stopword removal fused into a single pass,
+    with the outcome cached per raw token so that each token costs a single
+    lookup; cache misses are stemmed through the given FilterStem."""
+    def __init__(self, stem_filter, stopword_filter, cache_size=200000):
+        self.stem_filter = stem_filter
+        self.sw_set = stopword_filter.sw_set
+        self._filter = LRUCache(self._filter_token, cache_size)
+
+    def _filter_token(self, token):
+        """The filtered token, or None for a stopword."""
+        token = self.stem_filter._stem.cached(token.lower())
+        if token in self.sw_set:
+            return None
+        return token
+
+    def __call__(self, tokens):
+        fltr = self._filter.cached
+        for token in tokens:
+            token = fltr(token)
+            if token is not None:
+                yield token
+
+
+def fuse_filter_chain(chain):
+    """Replace a leading lowercase/stem/stopwords sequence of filters with the
+    equivalent FilterLowerStemStopwords; other chains are returned as they are."""
+    if (len(chain) >= 3
+            and chain[0] is filter_lowercase
+            and isinstance(chain[1], FilterStem)
+            and isinstance(chain[2], FilterStopwords)):
+        return [FilterLowerStemStopwords(chain[1], chain[2])] + list(chain[3:])
+    return chain
+
+
 def filter_chain(iterable, chain):
-    if len(chain) > 0:
-        my_fltr_fn = chain[0]
-        return filter_chain(my_fltr_fn(iterable), chain[1:])
-    else:
-        return iterable
+    return functools.reduce(lambda it, fltr_fn: fltr_fn(it), chain, iterable)
+
+
+def compile_filter_chain(chain):
+    """Generate a single generator function applying the whole chain with each
+    filter inlined into its loop. Chains with filters that cannot be inlined
+    fall back to filter_chain."""
+    env = {}
+    body = []
+    for n, fltr_fn in enumerate(chain):
+        name = '_f%d' % n
+        if fltr_fn is filter_gibberish:  # placeholder, passes tokens through
+            continue
+        elif fltr_fn is filter_lowercase:
+            body.append('t = t.lower()')
+        elif isinstance(fltr_fn, FilterStem):
+            env[name] = fltr_fn._stem.cached
+            body.append('t = %s(t)' % name)
+        elif isinstance(fltr_fn, FilterStopwords):
+            env[name] = fltr_fn.sw_set
+            body.append('if t in %s: continue' % name)
+        elif isinstance(fltr_fn, FilterLowerStemStopwords):
+            env[name] = fltr_fn._filter.cached
+            body.append('t = %s(t)' % name)
+            body.append('if t is None: continue')
+        else:
+            return functools.partial(filter_chain, chain=chain)
+
+    # the filters are bound as default arguments so that they are locals
+    src = 'def _run(tokens%s):\n' % ''.join(', %s=%s' % (name, name) for name in env)
+    src += '    for t in tokens:\n'
+    src += ''.join('        %s\n' % line for line in body)
+    src += '        yield t\n'
+    exec(src, env)
+    return env['_run']
 
 
 class ProgressMeasure(object):
@@ -163,6 +344,22 @@ class ESATerm(object):
         self.doc_list = doc_list
 
 
+class ESAVector(object):
+    """Sparse vector in the ESA space, kept as parallel arrays sorted by dim."""
+    ids = None        # document ids of the non-zero dims, ascending
+    vals = None       # values of those dims
+    sq_norm = None    # squared L2 norm, cached for similarity
+
+    def __init__(self, ids, vals):
+        self.ids = ids
+        self.vals = vals
+        self.sq_norm = float(vals @ vals)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64))
+
+
 class DocumentIterator(object):
     """Base class for iterating over a document collection."""
 
@@ -171,6 +368,15 @@ class DocumentIterator(object):
         Document classes."""
         raise NotImplementedException("Document iterator needs to implement this method.")
 
+    def iter_raw(self):
+        """Yield the documents before `clean_doc` is applied to their content,
+        so that a consumer can clean them elsewhere (e.g. in worker processes)."""
+        return iter(self)
+
+    def clean_doc(self, content):
+        """Turn raw document content into plain text."""
+        return content
+
 
 class WikidumpStreamDI(DocumentIterator):
     """Document iterator over the Wikipedia dump."""
@@ -179,49 +385,106 @@ class WikidumpStreamDI(DocumentIterator):
         self.bzname = bzname  # filename of the bzipped dump
         self.limit = limit
 
-    def _clean_doc(self, content):
+    def clean_doc(self, content):
         return wiki_extractor.clean(content)
 
+    def _open_dump(self):
+        """Open the dump as a stream of decompressed bytes, decompressing on
+        all cores when a parallel bzip2 decoder is available. Returns the
+        stream and the decoder process, if one was started."""
+        if ibz2 is not None:
+            return ibz2.open(self.bzname, parallelization=os.cpu_count()), None
+
+        for decoder in ("lbzip2", "pbzip2"):
+            if shutil.which(decoder):
+                proc = subprocess.Popen([decoder, "-dc", self.bzname], stdout=subprocess.PIPE)
+                return proc.stdout, proc
+
+        return bz2.BZ2File(self.bzname, "r"), None
+
+    def _iter_pages(self, bzfile):
+        """Parse the dump and yield its <page> elements, each of which is
+        thrown away as soon as the caller is done with it."""
+        if lxml_etree is not None:
+            # only pages are reported, the other elements are not tracked;
+            # any namespace goes, as it changes with the export format version
+            it = lxml_etree.iterparse(bzfile, events=("end", ), tag='{*}page',
+                                      huge_tree=True, recover=True)
+            for _, el in it:
+                yield el
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+        else:
+            it = ET.iterparse(bzfile, events=("start", "end", ))
+            _, root = next(it)
+            for ev, el in it:
+                if ev == "end" and el.tag.endswith('page'):
+                    yield el
+                    root.clear()
+
     def __iter__(self):
         """Load the dump, decompress it in a streaming fashion, parse it and
         yield the Wikipedia articles."""
-        bzfile = bz2.BZ2File(self.bzname, "r")
-
-        # start XML parsing
-        it = ET.iterparse(bzfile, events=("start", "end", ))
-        _, root = next(it)
+        for doc in self.iter_raw():
+            try:
+                doc.content = self.clean_doc(doc.content)
+            except Exception as e:
+                print("Error processing document", str(e))
+                continue
+            yield doc
+
+    def iter_raw(self):
+        """Same as iterating, but the articles are yielded still in wiki
+        markup."""
+        bzfile, decoder = self._open_dump()
 
         # note the time and counts (for performance measurements)
         pm = ProgressMeasure(label="loading wikipedia articles; done: ", target=self.limit)
-        for i, (ev, el, ) in enumerate(it):
-            if self.limit is not None and i >= self.limit:
-                break
+        try:
+            for i, el in enumerate(self._iter_pages(bzfile)):
+                if self.limit is not None and i >= self.limit:
+                    break
 
-            if ev == "end" and el.tag.endswith('page'):
                 try:
-                    doc_id = next(el.iterfind('{http://www.mediawiki.org/xml/export-0.10/}id')).text
-                    title = next(el.iterfind('{http://www.mediawiki.org/xml/export-0.10/}title')).text
-                    content = next(el.iterfind('{http://www.mediawiki.org/xml/export-0.10/}revision/{http://www.mediawiki.org/xml/export-0.10/}text')).text
-                    content = self._clean_doc(content)
+                    ns = el.tag[:-len('page')]  # e.g. '{http://www.mediawiki.org/xml/export-0.10/}'
+                    doc_id = el.find(ns + 'id').text
+                    title = el.find(ns + 'title').text
+                    content = el.find(ns + 'revision/' + ns + 'text').text
 #                     print(title, len(content))
                     yield Document(doc_id=doc_id, title=title, content=content)
                 except Exception as e:
                     print("Error processing document", str(e))
 
-                root.clear()  # throw away the data from the parsed tree, as they are processed
-
                 pm.tick()
+            else:
+                # a decoder dying midway just ends the stream, which the
+                # parser may well accept (lxml recovers from truncated XML)
+                if decoder is not None and decoder.wait() != 0:
+                    raise RuntimeError("%s failed to decompress %s (exit code %d)"
+                                       % (decoder.args[0], self.bzname, decoder.returncode))
+        finally:
+            bzfile.close()
+            if decoder is not None and decoder.poll() is None:  # stopped early
+                decoder.kill()
+                decoder.wait()
 
 
 class WordMap(dict):
+    def __missing__(self, word):
+        # unseen words get the next free term id
+        word_id = len(self)
+        self[word] = word_id
+        return word_id
+
     def save_idf(self, conn):
         curr, save_curr = conn.cursor(), conn.cursor()
         res = {}
         doc_cnt = float(curr.execute("SELECT count(*) from (select doc_id, count(*) from doc_term_freq group by doc_id)").fetchone()[0])
         for term_id, term_cnt in curr.execute("SELECT term_id,count(doc_id) FROM doc_term_freq GROUP BY term_id;"):
             idf = math.log(doc_cnt / term_cnt)
-            save_curr.execute("INSERT INTO term_idf VALUES (?, ?)", (term_id, idf,) )
             res[term_id] = idf
+        save_curr.executemany("INSERT INTO term_idf VALUES (?, ?)", res.items())
         return res
 
     def load_idf(self, conn):
@@ -233,23 +496,43 @@ class WordMap(dict):
 
     def save(self, conn):
         save_curr = conn.cursor()
-        for word, word_id in self.items():
-            save_curr.execute("INSERT INTO term_wordmap VALUES (?, ?)",
-                (word, word_id))
+        save_curr.executemany("INSERT INTO term_wordmap VALUES (?, ?)",
+            self.items())
 
 
 class WhitespaceTokenizer(object):
     """For tokenizing the text on whitespaces."""
+    _TOKEN_RE = (re2 or re).compile(r'[A-Za-z-]+')
+
     def tokenize(self, content):
         """Splits the input text into tokens."""
-        for token in re.findall('[A-Za-z-]*', content):
-            if len(token) > 0:
-                yield token
+        return self._TOKEN_RE.findall(content)
+
+
+# builder and document cleaner used by the worker processes of
+# BackgroundBuilder.load_documents
+_worker_builder = None
+_worker_clean_doc = None
+
+
+def _init_worker(builder, clean_doc):
+    global _worker_builder, _worker_clean_doc
+    _worker_builder = builder
+    _worker_clean_doc = clean_doc
+
+
+def _process_doc(doc):
+    """Clean a document and compute its term frequencies inside a worker process."""
+    return _worker_builder.process_doc(doc, _worker_clean_doc)
 
 
 class BackgroundBuilder(object):
     """Build the ESA background."""
 
+    # term frequencies are cached only for texts up to this many characters:
+    # redirects and boilerplate stubs repeat verbatim, full articles do not
+    tf_cache_max_len = 2000
+
     # queries for initializing the database
     drop_table_stmts = [
         "DROP TABLE IF EXISTS doc_term_freq",
@@ -263,29 +546,86 @@ class BackgroundBuilder(object):
         "CREATE TABLE term_idf (term_id int, idf float)",
         "CREATE TABLE term_wordmap (term text, term_id int)",
     ]
+    # indexes are built only once doc_term_freq is fully loaded; ndx_dtf
+    # covers iter_terms so that it never touches the table itself
+    create_index_stmts = [
+        "CREATE INDEX ndx_dtf ON doc_term_freq (term_id, freq DESC, doc_id)",
+        "CREATE INDEX ndx_dtf_doc ON doc_term_freq (doc_id)",
+    ]
+    # term_idf is joined by iter_terms, once save_idf has filled it
+    create_idf_index_stmts = [
+        "CREATE INDEX ndx_idf ON term_idf (term_id, idf)",
+    ]
+    # connection settings for a rebuild; durability is traded for speed as a
+    # failed build is simply re-run (page_size only applies to a new file,
+    # hence _reset_db starts a build from scratch)
+    build_pragma_stmts = [
+        "PRAGMA page_size=65536",
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=OFF",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-524288",
+        "PRAGMA mmap_size=30000000000",
+    ]
 
-    def __init__(self, db_file, labels_file, token_filter_chain, build=False):
+    def __init__(self, db_file, labels_file, token_filter_chain, build=False, workers=None,
+                 tf_cache_size=50000):
         self.wordmap = WordMap()
         self.tokenizer = WhitespaceTokenizer()
         self.token_filter_chain = token_filter_chain
+        self._filter = compile_filter_chain(token_filter_chain)
         self._build = build
+        self.workers = workers or os.cpu_count() or 1
+        # every worker keeps its own cache, so they share out @tf_cache_size
+        self.tf_cache_size = max(1, tf_cache_size // self.workers)
         self.db_file = db_file
         self.labels_file = labels_file
-        self.label_by_docid = dict([])
+        self._tf_cache = OrderedDict()  # text digest -> term frequencies
         self.conn = None
         self._connect_to_db()
 
+    def __getstate__(self):
+        # worker processes only tokenize; the database and the wordmap stay
+        # with the writer
+        state = self.__dict__.copy()
+        state.update(conn=None, wordmap=None, _filter=None,
+                     _tf_cache=OrderedDict())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._filter = compile_filter_chain(self.token_filter_chain)
+
     def compute_termfrequency(self, text):
         """Given the text compute freqency of each word."""
-        return Counter(self.tokenize(text)).most_common()
+        if len(text) > self.tf_cache_max_len:
+            return self._count_terms(text)
+
+        digest = text_digest(text)
+        term_freq = self._tf_cache.get(digest)
+        if term_freq is not None:
+            self._tf_cache.move_to_end(digest)
+            return term_freq
+
+        term_freq = self._count_terms(text)
+        self._tf_cache[digest] = term_freq
+        if len(self._tf_cache) > self.tf_cache_size:
+            self._tf_cache.popitem(last=False)
+        return term_freq
+
+    def _count_terms(self, text):
+        # save_doc_freq does not care about the order, so skip most_common's sort
+        return list(Counter(self.tokenize(text)).items())
 
     def tokenize(self, text):
         """Split text into tokens."""
-        for token in filter_chain(self.tokenizer.tokenize(text), self.token_filter_chain):
-            if not token in self.wordmap:  # add token into wordmap if needed
-                self.wordmap[token] = len(self.wordmap)
+        return self._filter(self.tokenizer.tokenize(text))
 
-            yield self.wordmap[token]
+    def intern_terms(self, term_freq):
+        """Replace the words of a term frequency list with their term ids."""
+        wordmap = self.wordmap
+        for token, freq in term_freq:
+            yield wordmap[token], freq
 
     def prepare_database(self):
         """Create/drop tables in database to prepare it for building the ESA background."""
@@ -296,36 +636,56 @@ class BackgroundBuilder(object):
         for tbl_stmt in self.create_table_stmts:
             curr.execute(tbl_stmt)
 
-    def create_index(self, table_name, curr):
-        """Instruct the database to create index on the given table."""
-        curr.execute("CREATE INDEX ndx_dtf ON %s (term_id, freq)" % table_name)
+    def create_index(self, curr):
+        """Instruct the database to create the indexes on doc_term_freq."""
+        for ndx_stmt in self.create_index_stmts:
+            curr.execute(ndx_stmt)
+
+    def create_idf_index(self, curr):
+        """Index term_idf and refresh the planner statistics of all tables."""
+        for ndx_stmt in self.create_idf_index_stmts:
+            curr.execute(ndx_stmt)
+        curr.execute("ANALYZE")
 
     def save_doc_freq(self, curr, doc_id, frq_vector):
         """Save records about term freqency of terms in the given document."""
-        for term_id, freq in frq_vector:
-            tf = 1.0 + math.log(freq)
-            curr.execute("INSERT INTO doc_term_freq VALUES ({term_id}, {doc_id}, {freq})".format(term_id=term_id, freq=tf, doc_id=doc_id))
-
-    def save_term(self, curr, term):
-        """Insert the term along with its document vector to the database."""
+        rows = [
+            (term_id, doc_id, 1.0 + math.log(freq))
+            for term_id, freq in frq_vector
+        ]
+        curr.executemany("INSERT INTO doc_term_freq VALUES (?, ?, ?)", rows)
+
+    def term_record(self, term):
+        """Build the (term_id, term_vector) row of the term table."""
         doc_list = sliding_window_filter(term.doc_list)  # be
-        curr.execute("INSERT INTO term VALUES(?, ?)",
-            #(term.term_id, buffer(binarize(doc_list))))
-            (term.term_id, binarize(doc_list)))
+        #return (term.term_id, buffer(binarize(doc_list)))
+        return (term.term_id, compress(binarize(doc_list)))
 
-    def save_terms(self, term_idf, min_freq=15):
+    def save_terms(self, term_idf, min_freq=15, batch_size=1000, idf_min=math.log(2), min_docs=1):
         curr = self.conn.cursor()
         save_curr = self.conn.cursor()
-        for term in self.iter_terms(curr, term_idf, min_freq=min_freq):
-            self.save_term(save_curr, term)
-
-    def iter_terms(self, curr, term_idf, min_freq=15):
-        res = curr.execute("SELECT term_id, doc_id, freq FROM doc_term_freq WHERE freq > ? ORDER BY term_id, freq DESC ", (min_freq, ))
+        batch = []
+        for term in self.iter_terms(curr, term_idf, min_freq=min_freq, idf_min=idf_min, min_docs=min_docs):
+            batch.append(self.term_record(term))
+            if len(batch) >= batch_size:
+                save_curr.executemany("INSERT INTO term VALUES(?, ?)", batch)
+                batch.clear()
+        save_curr.executemany("INSERT INTO term VALUES(?, ?)", batch)
+
+    def iter_terms(self, curr, term_idf, min_freq=15, idf_min=math.log(2), min_docs=1):
+        """Yield the terms with their tf-idf document lists. Terms with an idf
+        not above @idf_min (by default, those in half of the documents or more)
+        or found in fewer than @min_docs documents are skipped."""
+        res = curr.execute(
+            "SELECT dtf.term_id, dtf.doc_id, dtf.freq FROM doc_term_freq dtf "
+            "JOIN term_idf ti ON ti.term_id = dtf.term_id "
+            "WHERE ti.idf > ? AND dtf.freq > ? ORDER BY dtf.term_id, dtf.freq DESC ",
+            (idf_min, min_freq, ))
 
         term_rec = None
         curr_term = None
         curr_doc_list = []
-        curr_doc_list_sum = 0.0
+        curr_doc_list_sq_sum = 0.0
 
         while True:
             term_rec = res.fetchone()
@@ -333,51 +693,110 @@ class BackgroundBuilder(object):
                 break
 
             if curr_term != term_rec[0] and curr_term is not None:
-                normalize_vector(curr_doc_list, curr_doc_list_sum)
-                yield ESATerm(term_id=curr_term, doc_list=curr_doc_list)
+                if len(curr_doc_list) >= min_docs:
+                    normalize_vector(curr_doc_list, curr_doc_list_sq_sum)
+                    yield ESATerm(term_id=curr_term, doc_list=curr_doc_list)
 
                 curr_doc_list = []
-                curr_doc_list_sum = 0.0
+                curr_doc_list_sq_sum = 0.0
 
             curr_term = term_rec[0]
             tfidf = term_idf[curr_term] * term_rec[2]
             curr_doc_list.append((term_rec[1], tfidf, ))
-            curr_doc_list_sum += tfidf
+            curr_doc_list_sq_sum += tfidf * tfidf
 
 
     def _connect_to_db(self):
         self.conn = sqlite3.connect(self.db_file)
 
+    def _reset_db(self):
+        """Replace the database with an empty file and connect to it with the
+        build settings."""
+        self.conn.close()
+        for path in (self.db_file, self.db_file + '-wal', self.db_file + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+
+        self._connect_to_db()
+        for pragma_stmt in self.build_pragma_stmts:
+            self.conn.execute(pragma_stmt)
+
+    def process_doc(self, doc, clean_doc=None):
+        """Clean the document content, if a @clean_doc function is given, and
+        compute its term frequencies; None for documents that fail to clean."""
+        content = doc.content
+        if clean_doc is not None:
+            try:
+                content = clean_doc(content)
+            except Exception as e:
+                print("Error processing document", str(e))
+                return None
+        return doc.doc_id, doc.title, self.compute_termfrequency(content)
+
+    def iter_termfrequencies(self, doc_iter):
+        """Yield (doc_id, title, term_freq) for every document; with more than
+        one worker the documents are cleaned and tokenized in a pool of
+        processes. Document iterators are read raw, to clean the documents
+        there too; any other iterable must yield clean documents."""
+        clean_doc = None
+        if isinstance(doc_iter, DocumentIterator):
+            clean_doc = doc_iter.clean_doc
+            doc_iter = doc_iter.iter_raw()
+
+        if self.workers > 1:
+            with multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self, clean_doc)) as pool:
+                records = pool.imap_unordered(_process_doc, doc_iter, chunksize=32)
+                yield from (rec for rec in records if rec is not None)
+        else:
+            for doc in doc_iter:
+                rec = self.process_doc(doc, clean_doc)
+                if rec is not None:
+                    yield rec
+
     def load_documents(self, doc_iter):
         curr = self.conn.cursor()
-        for i, doc in enumerate(doc_iter):
-            content = doc.content
-            term_freq = self.compute_termfrequency(content)
-            self.save_doc_freq(curr, doc.doc_id, term_freq)
-            self.label_by_docid[doc.doc_id] = doc.title
-            self.__persist_explicit_labels(i)
-        self.create_index("doc_term_freq", curr)
+        labels = []  # (doc_id, title) not yet written out
+        with open(labels_path(self.labels_file), 'wb') as labels_fp:
+            for i, (doc_id, title, term_freq) in enumerate(self.iter_termfrequencies(doc_iter)):
+                self.save_doc_freq(curr, doc_id, self.intern_terms(term_freq))
+                labels.append((doc_id, title))
+                self.__persist_explicit_labels(labels_fp, labels, i)
+            self.__persist_explicit_labels(labels_fp, labels)
         curr.close()
-    
-    def __persist_explicit_labels(self, i, n=50):
-        if i and not i % n:
-            to_pickle(self.label_by_docid, self.labels_file)
+
+    def __persist_explicit_labels(self, labels_fp, labels, i=None, n=50):
+        """Append the pending @labels to the labels file and empty the list,
+        every @n documents (or right away when no @i is given)."""
+        if i is None or (i and not i % n):
+            labels_fp.writelines(to_jsonl_line(rec) for rec in labels)
+            labels_fp.flush()
+            labels.clear()
             return True
         return False
 
-    def build(self, doc_iter, min_freq=5):
+    def build(self, doc_iter, min_freq=5, idf_min=math.log(2), min_docs=1):
         if self._build:
+            self._reset_db()
+
+            # each bulk phase runs in a single explicit transaction
+            self.conn.execute("BEGIN")
             self.prepare_database()
             self.load_documents(doc_iter)
+            self.wordmap.save(self.conn)
             self.conn.commit()
 
-            self.wordmap.save(self.conn)
+            self.conn.execute("BEGIN")
+            self.create_index(self.conn.cursor())
             self.conn.commit()
 
             # build idf map
+            self.conn.execute("BEGIN")
             term_idf = self.wordmap.save_idf(self.conn)
+            self.create_idf_index(self.conn.cursor())
             self.conn.commit()
-            self.save_terms(term_idf, min_freq=min_freq)
+
+            self.conn.execute("BEGIN")
+            self.save_terms(term_idf, min_freq=min_freq, idf_min=idf_min, min_docs=min_docs)
         else:
             term_idf = self.wordmap.load_idf(self.conn)
         self.conn.commit()
@@ -395,21 +814,32 @@ class ESA(object):
         self.esa_index = None
         self.stemmer = None
 
-        self.label_by_docid = {
+        if os.path.exists(labels_path(self.labels_file)):
+            labels = from_jsonl(labels_path(self.labels_file))
+        else:  # backgrounds built before the labels were kept as JSON lines
+            labels = from_pickle(self.labels_file).items()
+        self._load_labels(labels)
+        self._load()
+
+    def _load_labels(self, labels):
+        """Keep the labels as two parallel arrays sorted by document id."""
+        label_by_docid = {
             int(docid): label
-            for docid, label in from_pickle(self.labels_file).items()
+            for docid, label in labels
         }
-        self._load()
+        label_ids = np.fromiter(label_by_docid.keys(), dtype=np.int32, count=len(label_by_docid))
+        label_titles = np.array(list(label_by_docid.values()), dtype=object)
+        order = np.argsort(label_ids)
+        self.label_ids = label_ids[order]
+        self.label_titles = label_titles[order]
 
     def _load(self):
         vectors = self.curr.execute("SELECT term, term_vector FROM term fv LEFT JOIN term_wordmap wm ON wm.term_id = fv.term_id")
         self.esa_index = {}
         for term, tv_str in vectors:
-            tv = {}
-            for i in range(0, len(tv_str), 8):
-                doc_id, doc_val = struct.unpack('if', tv_str[i:i+8])
-                tv[doc_id] = doc_val
-            self.esa_index[term] = tv
+            if term is None:  # vector without a word, never looked up
+                continue
+            self.esa_index[sys.intern(term)] = debinarize(decompress(tv_str))
 
     def tokenize(self, text):
         for word in filter_chain(self.tokenizer.tokenize(text), self.token_filter_chain):
@@ -417,56 +847,57 @@ class ESA(object):
 
 
     def get_vector(self, text, n_labels=5):
-        used_dims = set()
-        used_tvs = []
+        used_ids = []
+        used_vals = []
         for token in self.tokenize(text):
-            new_tv = self.esa_index.get(token, dict([]))
-            used_dims.update(new_tv.keys())
-            used_tvs.append(new_tv)
-
-        res_vec = {}
-        explicit_analysis = []
-        for dim in used_dims:
-            score = sum(tv.get(dim, 0.0) for tv in used_tvs)
-            res_vec[dim] = score
-            if dim in self.label_by_docid:
-                explicit_analysis.append(
-                    (self.label_by_docid[dim], score)
-                )
-        
-        explicit_analysis.sort(reverse=True, key=lambda x: x[1])
-        if n_labels:
-            explicit_analysis = explicit_analysis[:n_labels]
+            if token in self.esa_index:
+                tv = self.esa_index[token]
+                used_ids.append(tv['id'])
+                used_vals.append(tv['v'])
+
+        if not used_ids:
+            return [], ESAVector.empty()
+
+        # sum the term vectors: one scatter-add over the union of their dims
+        dims, inverse = np.unique(np.concatenate(used_ids), return_inverse=True)
+        scores = np.zeros(len(dims), dtype=np.float64)
+        np.add.at(scores, inverse, np.concatenate(used_vals))
+
+        return self._explicit_analysis(dims, scores, n_labels), ESAVector(dims, scores)
 
-        return explicit_analysis, res_vec
+    def _explicit_analysis(self, dims, scores, n_labels):
+        """Pair the labelled dims with their scores, best first."""
+        if not len(self.label_ids):
+            return []
+
+        ndx = np.minimum(np.searchsorted(self.label_ids, dims), len(self.label_ids) - 1)
+        labelled = self.label_ids[ndx] == dims
+        ndx, scores = ndx[labelled], scores[labelled]
+
+        order = np.argsort(-scores, kind='stable')
+        if n_labels:
+            order = order[:n_labels]
+        return list(zip(self.label_titles[ndx[order]].tolist(), scores[order].tolist()))
 
 
     def similarity(self, v1, v2):
-        dims = set(list(v1.keys()) + list(v2.keys()))
-        res = 0.0
-        res_norm_v1 = 0.0
-        res_norm_v2 = 0.0
-        for dim in dims:
-            v1_val = v1.get(dim, 0.0)
-            v2_val = v2.get(dim, 0.0)
-
-            res += v1_val * v2_val
-            res_norm_v1 += v1_val ** 2
-            res_norm_v2 += v2_val ** 2
-
-        if res_norm_v1 and res_norm_v2:
-            return res / math.sqrt(res_norm_v1 * res_norm_v2)
-        else:
+        if not (v1.sq_norm and v2.sq_norm):
             return 0.0
 
+        _, ndx1, ndx2 = np.intersect1d(
+            v1.ids, v2.ids, assume_unique=True, return_indices=True
+        )
+        res = float(v1.vals[ndx1] @ v2.vals[ndx2])
+        return res / math.sqrt(v1.sq_norm * v2.sq_norm)
+
 
 def get_token_filter_chain():
-    return [
+    return fuse_filter_chain([
             filter_lowercase,
             FilterStem(),
             FilterStopwords.from_set(set(['a', 'the'])),
             filter_gibberish,
-    ]
+    ])
 
 
 def test_esa(args):
@@ -498,7 +929,8 @@ def test_build_background(args):
         args.database,
         args.explicit,
         token_filter_chain=get_token_filter_chain(),
-        build=args.build
+        build=args.build,
+        workers=args.workers
     )
     bb.build(
         wsdi,
@@ -516,6 +948,7 @@ if __name__ == '__main__':
     )
     parser.add_argument('--database', type=str, default='esa_bg.db', help='') # TODO: add help
     parser.add_argument('--explicit', type=str, default='esa_labels.p', help='') # TODO: add help
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of tokenizer processes (default: one per core)')
     args = parser.parse_args()
 
     test_build_background(args)